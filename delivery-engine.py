@@ -1,9 +1,24 @@
-from sys import stdin
 from dataclasses import dataclass, asdict
-from types import NoneType
+from typing import Union, get_args, get_origin, get_type_hints
+from types import NoneType, UnionType
+import io
+import re
+import sys
 import time
 import json
 import unittest
+from contextlib import redirect_stdout
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:  # fall back to the stdlib parser
+    _loads = json.loads
+
+    def _dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
 
 TEST_DATA = [
     "{\"action\": \"send_package\", \"timestamp\": \"2142-08-23T02:40:12-0700\", \"sender_id\": 5, \"recipient_id\": 21, \"package_id\": 18571, \"package_type\": \"marketing\"}",
@@ -14,190 +29,434 @@ TEST_DATA = [
     "{\"action\": \"send_package\", \"timestamp\": \"2142-09-01T02:45:12+0100\", \"sender_id\": 42, \"recipient_id\": 21, \"package_id\": 2834, \"package_type\": \"personal\"}",
 ]
 
-ACTIONS = ("send_package", "update_preference")
-PACKAGE_TYPES = ("marketing", "personal")
+# interned, like the parsed values check_message() stores, so the dict and
+# frozenset lookups on them (_handlers, _PKG_MASK, ACTIONS) find the same
+# key object and skip comparing the strings
+SEND_PACKAGE = sys.intern("send_package")
+UPDATE_PREFERENCE = sys.intern("update_preference")
+MARKETING = sys.intern("marketing")
+PERSONAL = sys.intern("personal")
+
+ACTIONS = frozenset((SEND_PACKAGE, UPDATE_PREFERENCE))
+PACKAGE_TYPES = frozenset((MARKETING, PERSONAL))
+
+# "2142-08-23T02:40:12-0700" or "2142-08-24T23:40:12Z"
+_TIMESTAMP_RE = re.compile(
+    r"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(?:Z|[-+][0-9]{4})"
+)
+
+# orjson parses integers outside this range as floats, ids are bounded the
+# same way so the json fallback accepts exactly the same messages
+_INT_MIN = -(1 << 63)
+_INT_MAX = (1 << 64) - 1
+
+# package_id and action of a raw line, used to drop resent packages before
+# parsing them
+_PID_RE = re.compile(rb'[{,]\s*"package_id":\s*([0-9]+)\s*(?=[,}])')
+_ACTION_RE = re.compile(rb'[{,]\s*"action":\s*"([^"\\]*)"\s*(?=[,}])')
+_SEND_ACTION = SEND_PACKAGE.encode()
+
+# Recipient permission bits per package type
+_PKG_MASK = {PERSONAL: 1, MARKETING: 2}
+_ALL_PACKAGES = 3
+
+
+def _resolve(hint) -> tuple:
+    """Flattens a type hint into the tuple of concrete types it allows"""
+    origin = get_origin(hint)
+    if origin is Union or origin is UnionType:
+        return tuple(t for arg in get_args(hint) for t in _resolve(arg))
+    if origin is not None:
+        return (origin,)
+    if hint is None:
+        return (NoneType,)
+    return (hint,)
+
+
+AT_LEAST_ONE_REQUIRED_FIELDS = ("personal_package", "marketing_package")
+PERMISSIONS_FIELDS = ("personal_package", "marketing_package")
+
+# Allowed values and formats of fields, checked by the generated validators
+_FIELD_CHOICES = {"action": ACTIONS, "package_type": PACKAGE_TYPES}
+_FIELD_PATTERNS = {"timestamp": _TIMESTAMP_RE}
+
+
+def _make_validator(cls):
+    """Generates flat validate(), check_message() and to_dict() for a dataclass
+
+    validate() returns False for an invalid instance instead of raising and
+    appends the reason to errors when a list is passed. check_message()
+    applies the same rules to a parsed message dict, which may not carry
+    other keys, and returns it or None when it is invalid.
+    """
+    hints = get_type_hints(cls)
+    cls._field_checks = tuple(
+        (field_name, _resolve(hints[field_name]), hints[field_name])
+        for field_name in cls.__dataclass_fields__
+    )
+
+    namespace = {
+        "intern": sys.intern,
+        "_INT_MIN": _INT_MIN,
+        "_INT_MAX": _INT_MAX,
+        "_fields": cls.__dataclass_fields__.keys(),
+    }
+
+    def rules(get, fail, store=None):
+        lines = []
+        if set(AT_LEAST_ONE_REQUIRED_FIELDS) <= cls.__dataclass_fields__.keys():
+            checks = [f"{get(name)} is None" for name in AT_LEAST_ONE_REQUIRED_FIELDS]
+            lines.append(f"    if {' and '.join(checks)}:")
+            lines.extend(fail("'At least one field required'"))
+        for index, (field_name, types, hint) in enumerate(cls._field_checks):
+            checks = []
+            for type_index, expected_type in enumerate(types):
+                namespace[f"_type_{index}_{type_index}"] = expected_type
+                checks.append(f"type(value) is not _type_{index}_{type_index}")
+            namespace[f"_expected_{index}"] = hint
+            lines.append(f"    value = {get(field_name)}")
+            lines.append(f"    if {' and '.join(checks)}:")
+            lines.extend(
+                fail(f"f'{field_name}: {{type(value)}} instead of {{_expected_{index}}}'")
+            )
+            if int in types:
+                lines.append(
+                    "    if type(value) is int and not _INT_MIN <= value <= _INT_MAX:"
+                )
+                lines.extend(fail(f"f'{field_name}: <{{value}}> is out of range'"))
+            if field_name in _FIELD_CHOICES:
+                namespace[f"_choices_{index}"] = _FIELD_CHOICES[field_name]
+                lines.append(f"    if value not in _choices_{index}:")
+                lines.extend(fail(f"f'{field_name}: <{{value}}> is not valid'"))
+                if store is not None:
+                    lines.append(f"    {store(field_name)} = intern(value)")
+            if field_name in _FIELD_PATTERNS:
+                namespace[f"_pattern_{index}"] = _FIELD_PATTERNS[field_name].fullmatch
+                lines.append(f"    if _pattern_{index}(value) is None:")
+                lines.extend(fail(f"f'{field_name}: <{{value}}> is not valid'"))
+        return lines
+
+    lines = ["def validate(self, errors=None):"]
+    lines.extend(
+        rules(
+            lambda name: f"self.{name}",
+            lambda message: [
+                "        if errors is not None:",
+                f"            errors.append({message})",
+                "        return False",
+            ],
+        )
+    )
+    lines.append("    return True")
+
+    lines.append("def check_message(message):")
+    lines.append("    if not message.keys() <= _fields:")
+    lines.append("        return None")
+    lines.extend(
+        rules(
+            lambda name: f"message.get({name!r})",
+            lambda message: ["        return None"],
+            lambda name: f"message[{name!r}]",
+        )
+    )
+    lines.append("    return message")
+
+    items = ", ".join(f"{name!r}: self.{name}" for name in cls.__dataclass_fields__)
+    lines.append("def to_dict(self):")
+    lines.append(f"    return {{{items}}}")
+
+    exec(compile("\n".join(lines), f"<{cls.__name__} validator>", "exec"), namespace)
+    cls.validate = namespace["validate"]
+    cls.check_message = staticmethod(namespace["check_message"])
+    cls.to_dict = namespace["to_dict"]
+    return cls
+
+
+# (parsed message check, MessageServer handler name) by action
+_MESSAGE_TYPES = {}
+
+
+def register(action: str, handler: str):
+    """Registers the decorated dataclass's check_message() for action
+
+    Messages that pass the check are applied by the MessageServer method
+    named handler.
+    """
+
+    def decorator(cls):
+        _MESSAGE_TYPES[action] = (cls.check_message, handler)
+        return cls
+
+    return decorator
+
 
 # Dataclasses for validation and re-use data
-@dataclass
+@_make_validator
+@dataclass(repr=False, eq=False, match_args=False, slots=True)
 class Base:
     action: str  # send_package or update_preference
     timestamp: str  # "2142-08-23T02:40:12-0700"
     recipient_id: int
 
-    def validate(self):
-        for field_name, field_def in self.__dataclass_fields__.items():
-            try:
-                actual_type = field_def.type.__origin__
-            except AttributeError:
-                actual_type = field_def.type
-
-            actual_value = getattr(self, field_name)
-            if not isinstance(actual_value, actual_type):
-                raise Exception(
-                    f"{field_name}: {type(actual_value)} instead of {field_def.type}"
-                )
-
-            if field_name == "action":
-                action = getattr(self, field_name)
-                if action not in ACTIONS:
-                    raise Exception(f"{field_name}: <{actual_value}> not in actions")
 
-
-@dataclass
+@register(SEND_PACKAGE, "_process_package")
+@_make_validator
+@dataclass(repr=False, eq=False, match_args=False, slots=True)
 class SendPackage(Base):
     sender_id: int
     package_id: int
     package_type: str  # marketing or personal
 
-    def validate(self):
-        if self.package_type not in PACKAGE_TYPES:
-            raise Exception("package type is not valid")
-        return super().validate()
-
 
-@dataclass(init=True, repr=False)
+@register(UPDATE_PREFERENCE, "_update_preference")
+@_make_validator
+@dataclass(init=True, repr=False, eq=False, match_args=False, slots=True)
 class UpdatePackage(Base):
-
-    AT_LEAST_ONE_REQUIRED_FIELDS = (
-        "personal_package",
-        "marketing_package",
-    )
-
     personal_package: bool | NoneType = None
     marketing_package: bool | NoneType = None
 
-    def validate(self):
-        counter = 0
-        for item in self.AT_LEAST_ONE_REQUIRED_FIELDS:
-            value = getattr(self, item)
-            if value is None:
-                counter += 1
-            if counter == len(self.AT_LEAST_ONE_REQUIRED_FIELDS):
-                raise Exception("At least one field required")
-        return super().validate()
-
 
-@dataclass
+@dataclass(slots=True)
 class Recipient:
     id: int
 
     personal_package: bool = True
     marketing_package: bool = True
 
-    PERMISSIONS_FIELDS = ("personal_package", "marketing_package")
+
+def _is_deliverable(
+    recipient_id: int,
+    package_id: int,
+    mask: int,
+    perms: dict[int, int],
+    seen_packages: set[int],
+) -> bool:
+    """Tells whether package_id is new and allowed for the recipient"""
+    return package_id not in seen_packages and bool(
+        perms.get(recipient_id, _ALL_PACKAGES) & mask
+    )
+
+
+def _is_resent(line: bytes, seen_packages: set[int]) -> bool:
+    """Tells whether a raw send_package line repeats a delivered package_id
+
+    Lines with more than one package_id or action key are left to the
+    parser, which keeps the last one.
+    """
+    package_ids = _PID_RE.findall(line)
+    if len(package_ids) != 1 or int(package_ids[0]) not in seen_packages:
+        return False
+    return _ACTION_RE.findall(line) == [_SEND_ACTION]
 
 
 class MessageServer:
     def __init__(self, *args, **kwargs):
-        self._recipients = {}
-        self._packages = []
+        # _PKG_MASK bits per recipient, recipients not present allow everything
+        self._perms: dict[int, int] = {}
+        self._delivered = 0
+        # delivered package ids, and delivered updates by their content
+        self._seen_packages: set[int] = set()
+        self._seen_updates: set[tuple] = set()
         self._dropped = 0
         self._max_packages_count = kwargs.get("max_packages_count", None)
+        # delivered packages are written as json lines and flushed in chunks
+        self._out = io.BytesIO()
+        self._out_count = 0
+        self._flush_every = kwargs.get("flush_every", 1024)
+        self._handlers = {
+            action: getattr(self, handler)
+            for action, (_, handler) in _MESSAGE_TYPES.items()
+        }
 
     @staticmethod
-    def _validate_json(input: str) -> dict:
-        loaded_json = json.loads(input)
-        action_type = loaded_json.get("action", None)
-        if action_type is None:
-            raise Exception("Not valid action")
-        elif action_type == ACTIONS[0]:
-            item = SendPackage(**loaded_json)
-            item.validate()
-            return asdict(item)
-        elif action_type == ACTIONS[1]:
-            item = UpdatePackage(**loaded_json)
-            item.validate()
-            return asdict(item)
-        else:
-            raise Exception("Invalid action")
+    def _validate_json(input: bytes | str) -> dict | None:
+        """Parses a message and applies the check registered for its action
+
+        The parsed dict is checked in place (same rules as SendPackage and
+        UpdatePackage) instead of building a dataclass per message. Invalid
+        messages give None.
+        """
+        loaded_json = _loads(input)
+        if type(loaded_json) is not dict:
+            return None
+        action = loaded_json.get("action")
+        if type(action) is not str:
+            return None
+        message_type = _MESSAGE_TYPES.get(action)
+        if message_type is None:
+            return None
+        check, _ = message_type
+        return check(loaded_json)
 
     def _print_to_std(self, input):
-        print(input)
+        line = _dumps(input) + b"\n"
+        if self._out_count + 1 < self._flush_every:
+            self._out.write(line)
+            self._out_count += 1
+        else:
+            # the line is only kept once the write succeeded
+            self._write_out(line)
+
+    def flush(self):
+        if self._out_count:
+            self._write_out()
+
+    def _write_out(self, line: bytes = b""):
+        data = self._out.getvalue() + line
+        out = sys.stdout
+        out.flush()
+        buffer = getattr(out, "buffer", None)
+        if buffer is None:
+            out.write(data.decode())
+            out.flush()
+        else:
+            buffer.write(data)
+            buffer.flush()
+        self._out.seek(0)
+        self._out.truncate()
+        self._out_count = 0
 
     def _update_preference(self, input: dict) -> bool:
-        recipient_id = str(input.get("recipient_id"))
-
-        recipient = {"id": input.get("recipient_id")}
-        if input.get("personal_package") is not None:
-            recipient["personal_package"] = input.get("personal_package")
-        if input.get("marketing_package") is not None:
-            recipient["marketing_package"] = input.get("marketing_package")
-
-        if self._recipients.get(recipient_id, None) is None:
-            self._recipients[recipient_id] = recipient
-        self._recipients[recipient_id].update(recipient)
-
-        if input not in self._packages:
+        recipient_id = input["recipient_id"]
+
+        perms = self._perms.get(recipient_id, _ALL_PACKAGES)
+        personal_package = input.get("personal_package")
+        if personal_package is not None:
+            mask = _PKG_MASK[PERSONAL]
+            perms = perms | mask if personal_package else perms & ~mask
+        marketing_package = input.get("marketing_package")
+        if marketing_package is not None:
+            mask = _PKG_MASK[MARKETING]
+            perms = perms | mask if marketing_package else perms & ~mask
+        self._perms[recipient_id] = perms
+
+        key = (
+            input["recipient_id"],
+            input["timestamp"],
+            input.get("personal_package"),
+            input.get("marketing_package"),
+        )
+        if key not in self._seen_updates:
             self._print_to_std(input)
-            self._packages.append(input)
+            self._seen_updates.add(key)
+            self._delivered += 1
             return True
 
         self._dropped += 1
         return False
 
     def _process_package(self, input: dict) -> bool:
-        recipient_id = str(input.get("recipient_id"))
-        if self._recipients.get(recipient_id, None) is None:
-            recipient = {
-                "id": input.get("recipient_id"),
-                "personal_package": True,
-                "marketing_package": True,
-            }
-            self._recipients[str(recipient["id"])] = recipient
-
-        if input not in self._packages:
-            recipient = self._recipients[recipient_id]
-            if self._is_allowed_package(recipient, input):
-                self._print_to_std(input)
-                self._packages.append(input)
-                return True
+        package_id = input["package_id"]
+        if _is_deliverable(
+            input["recipient_id"],
+            package_id,
+            _PKG_MASK[input["package_type"]],
+            self._perms,
+            self._seen_packages,
+        ):
+            self._print_to_std(input)
+            self._seen_packages.add(package_id)
+            self._delivered += 1
+            return True
         self._dropped += 1
         return False
 
-    def process_input(self, input: str):
+    def process_input(self, input: bytes | str):
         if self._max_packages_count is not None and self._max_packages_count <= 0:
             self._dropped += 1
             return
 
         try:
+            if type(input) is str:
+                input = input.encode()
+            if _is_resent(input, self._seen_packages):
+                self._dropped += 1
+                return
+
             json = self._validate_json(input)
-            if json.get("action") == ACTIONS[0]:
-                ret = self._process_package(json)
-            else:
-                ret = self._update_preference(json)
+            if json is None:
+                self._dropped += 1
+                return
+            ret = self._handlers[json["action"]](json)
             if ret and self._max_packages_count is not None:
                 self._max_packages_count -= 1
         except Exception:
             self._dropped += 1
 
-    def _is_allowed_package(self, recipient: dict, request: dict) -> bool:
-        if (
-            recipient["marketing_package"] is True
-            and request["package_type"] == "marketing"
-        ):
-            return True
-        if (
-            recipient["personal_package"] is True
-            and request["package_type"] == "personal"
-        ):
-            return True
-        return False
+    def process_batch(self, lines):
+        """Parses the whole batch first, then applies the messages in order
+
+        Each message is handled exactly as process_input would. Attribute
+        lookups are hoisted into locals for the loops.
+        """
+        validate = self._validate_json
+        is_resent = _is_resent
+        seen_packages = self._seen_packages
+        messages = []
+        append = messages.append
+        for line in lines:
+            try:
+                if type(line) is str:
+                    line = line.encode()
+                if is_resent(line, seen_packages):
+                    append(None)
+                    continue
+                append(validate(line))
+            except Exception:
+                append(None)
+
+        handlers = self._handlers
+        max_packages_count = self._max_packages_count
+        dropped = 0
+        for json in messages:
+            if max_packages_count is not None and max_packages_count <= 0:
+                dropped += 1
+                continue
+            if json is None:
+                dropped += 1
+                continue
+
+            try:
+                ret = handlers[json["action"]](json)
+            except Exception:
+                dropped += 1
+                continue
+            if ret and max_packages_count is not None:
+                max_packages_count -= 1
+
+        self._max_packages_count = max_packages_count
+        self._dropped += dropped
 
     def results(self):
+        self.flush()
         return {
-            "packages_delivered": len(self._packages),
+            "packages_delivered": self._delivered,
             "packages_dropped": self._dropped,
         }
 
 
+def _read_lines(stream, chunk_size: int = 1 << 16):
+    """Yields lists of complete lines read from a binary stream in chunks"""
+    residual = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (residual + chunk).split(b"\n")
+        residual = lines.pop()
+        yield lines
+    if residual:
+        yield [residual]
+
+
 def server():
     start = time.time()
     server_instance = MessageServer()
 
     # for demonstration purpose only, i replace code from 212 line to input  TEST_DATA
-    # for line in stdin:
-    for item in TEST_DATA:
-        server_instance.process_input(item)
+    # for lines in _read_lines(sys.stdin.buffer):
+    #     server_instance.process_batch(lines)
+    server_instance.process_batch(TEST_DATA)
 
     print(server_instance.results())
     print(f"Processing took: {(time.time() - start):.2f} seconds")
@@ -234,26 +493,174 @@ class TestingProtocols(unittest.TestCase):
             asdict(SendPackage("send_package", "sssr", 12, 123, 1234, "personal")),
         )
 
+    def test_to_dict(self):
+        update = UpdatePackage("update_preference", "sssr", 12, marketing_package=True)
+        self.assertEqual(asdict(update), update.to_dict())
+
     def test_validate_update_package(self):
         data = {
             "action": "update_preference",
-            "timestamp": "12321",
+            "timestamp": "2142-08-24T23:40:12Z",
             "recipient_id": 1,
             "personal_package": True,
         }
         update = UpdatePackage(**data)
-        update.validate()
-
-
-# Test package_update 4
-# data = {'action': 'update_preference', 'timestamp': '12321', 'recipient_id': 1, 'personal_package' : True}
-# update = UpdatePackage(**data)
-# update.validate()
-# test validate "at least one field required"
-# data = {'action': 'update_preference', 'timestamp': '12321', 'recipient_id': 1}
-# update = UpdatePackage(**data)
-# update.validate()
-# unit tests with TEST_DATA
+        self.assertTrue(update.validate())
+        update.timestamp = "12321"
+        self.assertFalse(update.validate())
+
+    def test_validate_update_package_requires_one_field(self):
+        data = {"action": "update_preference", "timestamp": "12321", "recipient_id": 1}
+        update = UpdatePackage(**data)
+        errors = []
+        self.assertFalse(update.validate(errors))
+        self.assertEqual(["At least one field required"], errors)
+
+    def test_validate_json(self):
+        self.assertEqual(
+            MessageServer._validate_json(TEST_DATA[0]), json.loads(TEST_DATA[0])
+        )
+        self.assertIsNone(
+            MessageServer._validate_json(
+                "{\"action\": \"update_preference\", \"timestamp\": \"12321\", \"recipient_id\": 1}"
+            )
+        )
+        self.assertIsNone(
+            MessageServer._validate_json(
+                "{\"action\": \"send_package\", \"timestamp\": \"sssr\", \"sender_id\": 1, \"recipient_id\": \"2\", \"package_id\": 3, \"package_type\": \"personal\"}"
+            )
+        )
+        self.assertIsNone(
+            MessageServer._validate_json(TEST_DATA[0].replace("02:40:12", "02:40"))
+        )
+        for line in (
+            "[1, 2]",
+            "{\"action\": [\"x\"]}",
+            "{\"action\": \"update_preference\", \"recipient_id\": 1, \"personal_package\": true}",
+            TEST_DATA[0].replace("sender_id", "sender"),
+            TEST_DATA[0].replace("\"marketing\"", "[\"marketing\"]"),
+        ):
+            self.assertIsNone(MessageServer._validate_json(line))
+
+    def test_package_id_out_of_range(self):
+        line = TEST_DATA[0].replace("18571", str(2**70))
+        self.assertIsNone(MessageServer._validate_json(line))
+        largest = TEST_DATA[0].replace("18571", str((1 << 64) - 1))
+        self.assertIsNotNone(MessageServer._validate_json(largest))
+
+        server_instance = MessageServer()
+        server_instance._print_to_std = lambda input: None
+        server_instance.process_batch([line, TEST_DATA[1]])
+        self.assertEqual(
+            {"packages_delivered": 1, "packages_dropped": 1},
+            server_instance.results(),
+        )
+
+    def test_process_batch_handler_error_is_dropped(self):
+        def print_to_std(input):
+            if input["package_id"] == 1756:
+                raise OSError("broken pipe")
+
+        server_instance = MessageServer(max_packages_count=5)
+        server_instance._print_to_std = print_to_std
+        server_instance.process_batch(TEST_DATA[:2] + TEST_DATA[3:5])
+        self.assertEqual(
+            {"packages_delivered": 3, "packages_dropped": 1},
+            server_instance.results(),
+        )
+        self.assertEqual(2, server_instance._max_packages_count)
+
+    def test_failed_delivery_can_be_resent(self):
+        def print_to_std(input):
+            server_instance._print_to_std = lambda input: None
+            raise OSError("broken pipe")
+
+        server_instance = MessageServer()
+        server_instance._print_to_std = print_to_std
+        server_instance.process_input(TEST_DATA[4])
+        server_instance.process_input(TEST_DATA[4])
+        self.assertEqual(
+            {"packages_delivered": 1, "packages_dropped": 1},
+            server_instance.results(),
+        )
+
+    def test_print_to_std_writes_json_lines(self):
+        raw = io.BytesIO()
+        out = io.TextIOWrapper(raw, write_through=True)
+        server_instance = MessageServer(flush_every=3)
+        with redirect_stdout(out):
+            for item in TEST_DATA[:2]:
+                server_instance.process_input(item)
+            self.assertEqual(b"", raw.getvalue())
+            server_instance.process_input(TEST_DATA[2])
+            self.assertEqual(
+                [json.loads(item) for item in TEST_DATA[:3]],
+                [json.loads(line) for line in raw.getvalue().splitlines()],
+            )
+            server_instance.process_input(TEST_DATA[1].replace("1756", "1757"))
+            server_instance.results()
+        self.assertEqual(4, len(raw.getvalue().splitlines()))
+
+        text = io.StringIO()
+        server_instance = MessageServer()
+        with redirect_stdout(text):
+            server_instance.process_input(TEST_DATA[0])
+            self.assertEqual(1, server_instance.results()["packages_delivered"])
+        self.assertEqual(json.loads(TEST_DATA[0]), json.loads(text.getvalue()))
+
+    def test_read_lines(self):
+        stream = io.BytesIO("\n".join(TEST_DATA).encode())
+        lines = [line for chunk in _read_lines(stream, 100) for line in chunk]
+        self.assertEqual([line.encode() for line in TEST_DATA], lines)
+
+    def test_resent_package_delivered_once(self):
+        server_instance = MessageServer()
+        server_instance._print_to_std = lambda input: None
+        server_instance.process_input(TEST_DATA[4])
+        server_instance.process_input(TEST_DATA[4])
+        server_instance.process_input(TEST_DATA[5])
+        self.assertEqual(
+            {"packages_delivered": 1, "packages_dropped": 2},
+            server_instance.results(),
+        )
+
+    def test_is_resent(self):
+        seen_packages = {18571}
+        self.assertTrue(_is_resent(TEST_DATA[0].encode(), seen_packages))
+        update = TEST_DATA[2].replace(
+            "\"recipient_id\"", "\"package_id\": 18571, \"recipient_id\""
+        )
+        self.assertFalse(_is_resent(update.encode(), seen_packages))
+
+    def test_update_preference_blocks_package_type(self):
+        server_instance = MessageServer()
+        server_instance._print_to_std = lambda input: None
+        server_instance.process_input(
+            "{\"action\": \"update_preference\", \"timestamp\": \"2142-08-24T23:40:12Z\", \"recipient_id\": 21, \"marketing_package\": false}"
+        )
+        server_instance.process_input(TEST_DATA[3])
+        server_instance.process_input(TEST_DATA[4])
+        self.assertEqual(
+            {"packages_delivered": 2, "packages_dropped": 1},
+            server_instance.results(),
+        )
+
+    def test_process_batch_matches_process_input(self):
+        # the parser keeps the last of duplicate keys, here a new package_id
+        resent = TEST_DATA[1].replace(
+            "\"package_id\": 1756", "\"package_id\": 18571, \"package_id\": 1757"
+        )
+        lines = ["not json", TEST_DATA[0], resent] + TEST_DATA[1:]
+        single_out, batch_out = [], []
+        single = MessageServer(max_packages_count=2)
+        single._print_to_std = single_out.append
+        for item in lines:
+            single.process_input(item)
+        batch = MessageServer(max_packages_count=2)
+        batch._print_to_std = batch_out.append
+        batch.process_batch(lines)
+        self.assertEqual(single.results(), batch.results())
+        self.assertEqual(single_out, batch_out)
 
 
 if __name__ == "__main__":